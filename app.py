@@ -4,60 +4,235 @@
 # (PP_latitud, PP_longitud) and (lat, lng),
 # using custom markers with numbers and colors based on conditions.
 
+import io
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_numeric_dtype
 import streamlit as st
 from pathlib import Path
 import folium
-from streamlit_folium import st_folium
+
+# Copy-on-Write is always on from pandas 3.0; opt in on older versions
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
 
 st.set_page_config(page_title="Mapa de direcciones", layout="wide")
 
 # ---------- Helpers ----------
 
-def load_dataframe(csv_path: Path) -> pd.DataFrame:
-    df = pd.read_csv(csv_path)
-    df = df.copy().reset_index(drop=True)
-    df["record_id"] = df.index + 1
-    df = df.set_index("record_id")
-    return df
+DEFAULT_CSV_PATH = Path("direcciones_X.csv")
+REQUIRED_COLUMNS = ["PP_latitud", "PP_longitud", "lat", "lng", "PP_method", "score", "PP_diferencia"]
+NUM_COLS = ["PP_latitud", "PP_longitud", "lat", "lng", "PP_diferencia", "score"]
+UPLOAD_CHUNKSIZE = 200_000
+
+# Drop inner blanks and turn decimal commas into points in one pass per string
+_TRANS = str.maketrans({" ": "", "\t": "", ",": "."})
 
 def to_float_series(series: pd.Series) -> pd.Series:
-    text = (
-        series.astype(str)
-        .str.strip()
-        .str.replace(" ", "", regex=False)
-        .str.replace(",", ".", regex=False)
-    )
-    return pd.to_numeric(text, errors="coerce")
+    # Columns pandas already parsed as numbers need no string cleanup
+    if is_numeric_dtype(series):
+        return series.astype(float)
+    # strip() first: it also removes surrounding non-breaking/Unicode whitespace
+    text = series.astype("string").str.strip().str.translate(_TRANS)
+    # "string" dtype yields nullable Float64; return plain float64 with NaN
+    return pd.to_numeric(text, errors="coerce").astype(float)
 
 def validate_required_columns(df: pd.DataFrame, required_cols: list[str]) -> list[str]:
     return [c for c in required_cols if c not in df.columns]
 
-def make_numbered_icon(number: int, color: str) -> folium.DivIcon:
-    """Create a circular marker with a number and background color."""
-    html = f"""
-    <div style="
-        background-color:{color};
-        border-radius:50%;
-        width:28px;
-        height:28px;
-        display:flex;
-        align-items:center;
-        justify-content:center;
-        color:white;
-        font-weight:bold;
-        border:2px solid black;">
-        {number}
-    </div>
+def prepare_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, np.ndarray], list[str]]:
+    """Index records from 1, convert coordinate/score columns to floats and
+    expose the required columns as numpy arrays for positional lookups."""
+    df = df.reset_index(drop=True)
+    df["record_id"] = df.index + 1
+    df = df.set_index("record_id")
+    # record_id is 1..N, so record N is always at position N-1 (see render_record_view)
+
+    missing_columns = validate_required_columns(df, REQUIRED_COLUMNS)
+    if len(missing_columns) > 0:
+        return df, {}, missing_columns
+
+    df[NUM_COLS] = df[NUM_COLS].apply(to_float_series, axis=0)
+    arrays = {c: df[c].to_numpy() for c in REQUIRED_COLUMNS}
+
+    # Marker decisions precomputed for every record (kept out of df so the
+    # record table only shows CSV columns)
+    # The PP_method == "EXACT" requirement is intentionally disabled
+    arrays["_pp_condition"] = (df["PP_diferencia"] < 100).to_numpy(dtype=bool)
+    arrays["_geo_color"] = np.where(df["score"] > 0.5, "green", "gray")
+    arrays["_valid_geo"] = df[["lat", "lng"]].notna().all(axis=1).to_numpy()
+    arrays["_pp_has_coords"] = df[["PP_latitud", "PP_longitud"]].notna().all(axis=1).to_numpy()
+    return df, arrays, missing_columns
+
+def read_records_csv(source, chunksize: int | None = None) -> pd.DataFrame:
+    """Parse a CSV.
+
+    Every column is kept: the record table shows the full row, which is what
+    a reviewer needs to judge a geocode. By default the multithreaded
+    pyarrow engine (shipped with streamlit) is used; with `chunksize` the C
+    engine parses the file in bounded chunks, which keeps peak memory down
+    for large uploads.
+    """
+    if chunksize is None:
+        try:
+            return pd.read_csv(source, engine="pyarrow")
+        except pd.errors.ParserError:
+            # pyarrow rejects short rows that the C engine pads with NaN
+            if hasattr(source, "seek"):
+                source.seek(0)
+            return pd.read_csv(source, engine="c")
+    with pd.read_csv(source, engine="c", chunksize=chunksize) as reader:
+        return pd.concat(reader, ignore_index=True)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _probe_default() -> float | None:
+    """mtime of DEFAULT_CSV_PATH, or None if it does not exist.
+
+    Cached for a few seconds so reruns (e.g. number_input keypresses) do not
+    stat the disk every time.
     """
-    return folium.DivIcon(html=html)
+    try:
+        return DEFAULT_CSV_PATH.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+@st.cache_data(show_spinner=False)
+def load_dataframe(csv_path: Path, mtime: float) -> tuple[pd.DataFrame, dict[str, np.ndarray], list[str]]:
+    """Cached load of a local CSV; `mtime` invalidates the cache when the file changes."""
+    return prepare_dataframe(read_records_csv(csv_path))
+
+@st.cache_data(show_spinner=False)
+def load_uploaded(file_bytes: bytes, name: str) -> tuple[pd.DataFrame, dict[str, np.ndarray], list[str]]:
+    """Cached load of an uploaded CSV, keyed on its raw bytes."""
+    return prepare_dataframe(read_records_csv(io.BytesIO(file_bytes), chunksize=UPLOAD_CHUNKSIZE))
+
+# Marker options shared by every numbered marker, built once at import
+_MARKER_STYLE = {"radius": 14, "color": "black", "weight": 2, "fill": True, "fill_opacity": 1.0}
+_MARKER_LABEL_OPTIONS = {"sticky": False, "permanent": True, "direction": "center", "className": "marker-number"}
+# Strip Leaflet's tooltip box so the number reads as white bold text inside
+# the coloured circle instead of covering it
+_MARKER_LABEL_CSS = """
+<style>
+    .leaflet-tooltip.marker-number {
+        background: transparent;
+        border: none;
+        box-shadow: none;
+        padding: 0;
+        color: white;
+        font-weight: bold;
+    }
+    .leaflet-tooltip.marker-number::before {
+        display: none;
+    }
+</style>
+"""
+
+def make_base_map(location: list[float]) -> folium.Map:
+    """Create an empty map with the styles numbered markers rely on."""
+    folium_map = folium.Map(location=location, zoom_start=15, control_scale=True, prefer_canvas=True)
+    folium_map.get_root().header.add_child(folium.Element(_MARKER_LABEL_CSS))
+    return folium_map
+
+def make_numbered_marker(location: list[float], number: int, color: str, popup: str) -> folium.CircleMarker:
+    """Create a circular vector marker labelled with a number.
+
+    Unlike a DivIcon Marker, a CircleMarker is drawn as a path (canvas when
+    enabled) instead of its own DOM element, so it scales to many points.
+    """
+    return folium.CircleMarker(
+        location=location,
+        fill_color=color,
+        popup=popup,
+        tooltip=folium.Tooltip(str(number), **_MARKER_LABEL_OPTIONS),
+        **_MARKER_STYLE,
+    )
+
+def build_map(
+    pp_latitude: float,
+    pp_longitude: float,
+    geo_latitude: float,
+    geo_longitude: float,
+    pp_visible: bool,
+    geo_color: str,
+    pp_method: str,
+    pp_difference: float,
+    geo_score: float,
+) -> folium.Map:
+    """Build the Folium map for one record.
+
+    Without a visible PP point the map is just the geocoded marker at the
+    default zoom: no midpoint, line or fit_bounds.
+    """
+    geo_marker = make_numbered_marker(
+        location=[geo_latitude, geo_longitude],
+        number=1,
+        color=geo_color,
+        popup=f"Geocoded: ({geo_latitude:.6f}, {geo_longitude:.6f}) | score={geo_score}",
+    )
+
+    if not pp_visible:
+        folium_map = make_base_map([geo_latitude, geo_longitude])
+        geo_marker.add_to(folium_map)
+        return folium_map
+
+    # Both points shown: center on the midpoint, join them and fit the view
+    center_latitude = (pp_latitude + geo_latitude) / 2.0
+    center_longitude = (pp_longitude + geo_longitude) / 2.0
+    folium_map = make_base_map([center_latitude, center_longitude])
+
+    make_numbered_marker(
+        location=[pp_latitude, pp_longitude],
+        number=2,
+        color="green",
+        popup=f"PP: ({pp_latitude:.6f}, {pp_longitude:.6f}) | PP_method={pp_method} | PP_diferencia={pp_difference}",
+    ).add_to(folium_map)
+    geo_marker.add_to(folium_map)
+
+    folium.PolyLine(
+        locations=[[pp_latitude, pp_longitude], [geo_latitude, geo_longitude]],
+        weight=3,
+        opacity=0.8
+    ).add_to(folium_map)
+    folium_map.fit_bounds([[pp_latitude, pp_longitude], [geo_latitude, geo_longitude]])
+    return folium_map
+
+@st.cache_resource(max_entries=256, show_spinner=False)
+def render_map_html(
+    record_id: int,
+    pp_latitude: float,
+    pp_longitude: float,
+    geo_latitude: float,
+    geo_longitude: float,
+    pp_visible: bool,
+    geo_color: str,
+    pp_method: str,
+    pp_difference: float,
+    geo_score: float,
+) -> str:
+    """Render the map for one record to HTML.
+
+    The output depends only on the arguments, so reselecting a record is
+    served from the cache without rebuilding or re-rendering the map.
+    """
+    folium_map = build_map(
+        pp_latitude,
+        pp_longitude,
+        geo_latitude,
+        geo_longitude,
+        pp_visible,
+        geo_color,
+        pp_method,
+        pp_difference,
+        geo_score,
+    )
+    return folium_map.get_root().render()
 
 # ---------- UI: Sidebar ----------
 
 st.sidebar.title("Configuración")
 
-default_path = Path("direcciones_X.csv")
-file_exists = default_path.exists()
+default_mtime = _probe_default()
+file_exists = default_mtime is not None
 
 uploaded_file = st.sidebar.file_uploader(
     "Opcional: subí un CSV (si no, se usará 'direcciones_X.csv' de la carpeta actual)",
@@ -69,30 +244,26 @@ st.sidebar.markdown(f"**Fuente de datos:** {data_source_label}")
 
 # ---------- Load data ----------
 
-if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
-    df = df.copy().reset_index(drop=True)
-    df["record_id"] = df.index + 1
-    df = df.set_index("record_id")
-elif file_exists:
-    df = load_dataframe(default_path)
-else:
+if uploaded_file is None and not file_exists:
     st.error("No se encontró 'direcciones_X.csv' y no se subió ningún archivo.")
     st.stop()
 
-required_columns = ["PP_latitud", "PP_longitud", "lat", "lng", "PP_method", "score", "PP_diferencia"]
-missing_columns = validate_required_columns(df, required_columns)
+try:
+    if uploaded_file is not None:
+        df, arrays, missing_columns = load_uploaded(uploaded_file.getvalue(), uploaded_file.name)
+    else:
+        df, arrays, missing_columns = load_dataframe(DEFAULT_CSV_PATH, default_mtime)
+except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as error:
+    st.error(f"No se pudo leer el CSV: {error}")
+    st.stop()
+
 if len(missing_columns) > 0:
     st.error(f"Faltan columnas requeridas en el CSV: {', '.join(missing_columns)}")
     st.stop()
 
-df = df.copy()
-df["PP_latitud"] = to_float_series(df["PP_latitud"])
-df["PP_longitud"] = to_float_series(df["PP_longitud"])
-df["lat"] = to_float_series(df["lat"])
-df["lng"] = to_float_series(df["lng"])
-df["PP_diferencia"] = to_float_series(df["PP_diferencia"])
-df["score"] = to_float_series(df["score"])
+if df.empty:
+    st.error("El CSV no contiene registros.")
+    st.stop()
 
 # ---------- UI: Main ----------
 
@@ -101,77 +272,61 @@ st.title("Evaluación de Georeferenciación")
 total_records = int(df.index.max())
 st.caption(f"Registros disponibles: {total_records+1}")
 
-selected_record_id = st.number_input(
-    f"Seleccionar Número de Registro (1-{total_records+1}):",
-    min_value=1,
-    max_value=total_records,
-    value=1,
-    step=1,
-)
-
-row = df.loc[int(selected_record_id)]
-
-pp_latitude = row["PP_latitud"]
-pp_longitude = row["PP_longitud"]
-geo_latitude = row["lat"]
-geo_longitude = row["lng"]
-
-# Only require geocoded coordinates; ignore PP if invalid/missing
-if pd.isna(geo_latitude) or pd.isna(geo_longitude):
-    st.warning("El registro seleccionado no tiene lat/lng válidos.")
-    st.dataframe(row.to_frame().T, use_container_width=True)
-    st.stop()
-
-# ---------- Build Folium map ----------
-
-# PP validity flag: both coords must be present and numeric
-pp_valid = pd.notna(pp_latitude) and pd.notna(pp_longitude)
-
-# Map center: if PP invalid, center on geocoded; else, midpoint
-if pp_valid:
-    center_latitude = (pp_latitude + geo_latitude) / 2.0
-    center_longitude = (pp_longitude + geo_longitude) / 2.0
-else:
-    center_latitude = float(geo_latitude)
-    center_longitude = float(geo_longitude)
-
-folium_map = folium.Map(location=[center_latitude, center_longitude], zoom_start=15, control_scale=True)
-
-# Decide colors / condition (as requested)
-#pp_condition = (str(row["PP_method"]).upper() == "EXACT") and (float(row["PP_diferencia"]) < 100)
-pp_condition = float(row["PP_diferencia"]) < 100
-geo_color = "green" if float(row["score"]) > 0.5 else "gray"
-
-# Add PP marker (number 2) only if PP exists AND condition is true (green)
-if pp_valid and pp_condition:
-    folium.Marker(
-        location=[pp_latitude, pp_longitude],
-        tooltip="PP point",
-        popup=f"PP: ({pp_latitude:.6f}, {pp_longitude:.6f}) | PP_method={row['PP_method']} | PP_diferencia={row['PP_diferencia']}",
-        icon=make_numbered_icon(2, "green")
-    ).add_to(folium_map)
-
-# Add Geocoded marker (number 1)
-folium.Marker(
-    location=[geo_latitude, geo_longitude],
-    tooltip="Geocoded point",
-    popup=f"Geocoded: ({geo_latitude:.6f}, {geo_longitude:.6f}) | score={row['score']}",
-    icon=make_numbered_icon(1, geo_color)
-).add_to(folium_map)
+# Only this section reruns when the record number changes; the sidebar,
+# uploader and data loading above are left untouched
+@st.fragment
+def render_record_view(df: pd.DataFrame, arrays: dict[str, np.ndarray]) -> None:
+    selected_record_id = st.number_input(
+        f"Seleccionar Número de Registro (1-{total_records+1}):",
+        min_value=1,
+        max_value=total_records,
+        value=1,
+        step=1,
+    )
 
-# Draw line only if marker 2 is visible (and PP is valid)
-if pp_valid and pp_condition:
-    folium.PolyLine(
-        locations=[[pp_latitude, pp_longitude], [geo_latitude, geo_longitude]],
-        weight=3,
-        opacity=0.8
-    ).add_to(folium_map)
+    # Read scalars straight from the cached arrays; record_id N is position N-1
+    record_position = int(selected_record_id) - 1
+
+    pp_latitude = arrays["PP_latitud"][record_position]
+    pp_longitude = arrays["PP_longitud"][record_position]
+    geo_latitude = arrays["lat"][record_position]
+    geo_longitude = arrays["lng"][record_position]
+    pp_method = arrays["PP_method"][record_position]
+    pp_difference = arrays["PP_diferencia"][record_position]
+    geo_score = arrays["score"][record_position]
+
+    # Only require geocoded coordinates; ignore PP if invalid/missing
+    if not arrays["_valid_geo"][record_position]:
+        st.warning("El registro seleccionado no tiene lat/lng válidos.")
+        st.table(df.iloc[[record_position]])
+        return
+
+    # Decide validity / colors / condition (precomputed in prepare_dataframe)
+    pp_valid = bool(arrays["_pp_has_coords"][record_position])
+    pp_condition = bool(arrays["_pp_condition"][record_position])
+    geo_color = str(arrays["_geo_color"][record_position])
+
+    # PP marker (number 2) and the line are shown only if PP exists AND the condition holds
+    pp_visible = pp_valid and pp_condition
+
+    map_html = render_map_html(
+        int(selected_record_id),
+        float(pp_latitude),
+        float(pp_longitude),
+        float(geo_latitude),
+        float(geo_longitude),
+        pp_visible,
+        geo_color,
+        str(pp_method),
+        float(pp_difference),
+        float(geo_score),
+    )
 
-# Fit bounds only if both points are present; else remain centered on geocoded
-if pp_valid and pp_condition:
-    folium_map.fit_bounds([[pp_latitude, pp_longitude], [geo_latitude, geo_longitude]])
+    # Display-only map: embed static HTML instead of st_folium, which streams
+    # pan/zoom state back to Python and reruns the script on every interaction
+    st.iframe(map_html, height=520)
 
-st_folium(folium_map, use_container_width=True, height=520)
+    st.subheader("Registro seleccionado")
+    st.table(df.iloc[[record_position]])
 
-st.subheader("Registro seleccionado")
-st.dataframe(row.to_frame().T, use_container_width=True)
+render_record_view(df, arrays)